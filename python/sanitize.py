@@ -33,6 +33,7 @@ __author__ = 'dcphillips@google.com (David Phillips)'
 import functools
 import html as html_module
 import re
+import string
 
 from . import generated_sanitize
 
@@ -63,6 +64,12 @@ _HTML5_VOID_ELEMENTS_RE = re.compile(
     '|keygen|link|meta|param|source|track|wbr)\\b')
 
 
+# The names of all HTML5 void elements.
+_HTML5_VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'command', 'embed', 'hr', 'img', 'input',
+    'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'))
+
+
 # An innocuous output to replace filtered content with.
 # For details on its usage, see the description in
 _INNOCUOUS_OUTPUT = 'zSoyz'
@@ -72,6 +79,19 @@ _INNOCUOUS_OUTPUT = 'zSoyz'
 _NEWLINE_RE = re.compile('(\r\n|\r|\n)')
 
 
+# Translation table that escapes every '<' as an entity.
+_LT_TRANSLATE = str.maketrans({'<': '&lt;'})
+
+
+# Translation table that lowercases ASCII letters only.
+_ASCII_LOWER_TRANSLATE = str.maketrans(string.ascii_uppercase,
+                                       string.ascii_lowercase)
+
+
+# The default whitelist of tags preserved by clean_html.
+_SAFE_TAG_WHITELIST_SET = frozenset(generated_sanitize._SAFE_TAG_WHITELIST)
+
+
 # Regex for finding replacement tags.
 _REPLACEMENT_TAG_RE = re.compile(r'\[(\d+)\]')
 
@@ -95,57 +115,229 @@ def change_newline_to_br(value):
 
   if html is not None:
     result = _NEWLINE_RE.sub('<br>', html)
-    approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-        'Persisting existing sanitization.')
-    return SanitizedHtml(result, get_content_dir(value), approval=approval)
+    return SanitizedHtml(result, get_content_dir(value),
+                         approval=_PERSISTING_SANITIZATION_APPROVAL)
 
   return _NEWLINE_RE.sub('<br>', str(value))
 
 
 def clean_html(value, safe_tags=None):
+  html = _get_content_of_kind(value, CONTENT_KIND.HTML)
+  if html is not None:
+    return SanitizedHtml(html, get_content_dir(value),
+                         approval=_PERSISTING_SANITIZATION_APPROVAL)
+
   if not safe_tags:
-    safe_tags = generated_sanitize._SAFE_TAG_WHITELIST
+    safe_tags = _SAFE_TAG_WHITELIST_SET
   else:
     # Join the provided list with the default whitelist.
-    safe_tags = list(
-        set(safe_tags).union(generated_sanitize._SAFE_TAG_WHITELIST))
+    safe_tags = _merge_safe_tags(tuple(safe_tags))
 
-  html = _get_content_of_kind(value, CONTENT_KIND.HTML)
-  if html is not None:
-    approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-        'Persisting existing sanitization.')
-    return SanitizedHtml(html, get_content_dir(value), approval=approval)
-
-  approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-      'Escaped html is by nature sanitized.')
   return SanitizedHtml(_strip_html_tags(value, safe_tags),
-                       get_content_dir(value), approval=approval)
+                       get_content_dir(value), approval=_ESCAPED_HTML_APPROVAL)
 
 # LINT.IfChange(htmlToText)
-_TAG_RE = re.compile(
-    r'<(?:!--.*?--|(?:!|(/?[a-z][\w:-]*))((?:[^>\'"]|"[^"]*"|\'[^\']*\')*))>|\Z',
-    re.IGNORECASE)
+# Tags are found by _iter_tags, which matches the same tags as
+#   <(?:!--.*?--|(?:!|(/?[a-z][\w:-]*))((?:[^>'"]|"[^"]*"|'[^']*')*))>
+# with re.IGNORECASE. Running that regex with finditer rescans the rest of the
+# input from every '<' of an unterminated tag, which is quadratic.
+_TAG_NAME_RE = re.compile(r'/?[a-z][\w:-]*', re.IGNORECASE)
+# Matches the attributes of a tag up to its closing '>' as long as they contain
+# no '<', which bounds every attempt by the next '<' in the input.
+_TAG_ATTRS_RE = re.compile(r'[^<>"\']*(?:(?:"[^<"]*"|\'[^<\']*\')[^<>"\']*)*>')
+_TAG_ATTRS_DELIMITER_RE = re.compile(r'[>"\']')
 _ATTR_RE = re.compile(
     r'([a-zA-Z][a-zA-Z0-9:\\-]*)[\t\n\r ]*=[\t\n\r ]*("[^"]*"|\'[^\']*\')')
 _STYLE_RE = re.compile(
     r'[\t\n\r ]*([^:;\t\n\r ]*)[\t\n\r ]*:[\t\n\r ]*([^:;\t\n\r ]*)[\t\n\r ]*(?:;|\Z)'
 )
-_REMOVING_TAGS_RE = re.compile(r'(script|style|textarea|title)$', re.IGNORECASE)
-_WS_PRESERVING_TAGS_RE = re.compile(r'pre$', re.IGNORECASE)
-_NEWLINE_TAGS_RE = re.compile(r'br$', re.IGNORECASE)
-_BLOCK_TAGS_RE = re.compile(
-    r'/?(address|blockquote|dd|div|dl|dt|h[1-6]|hr|li|ol|p|pre|table|tr|ul)$',
-    re.IGNORECASE)
-_TAB_TAGS_RE = re.compile(r'(td|th)$', re.IGNORECASE)
-_HTML_WHITESPACE_RE = re.compile(r'[ \t\r\n]+')
-_TRAILING_NON_WHITESPACE_RE = re.compile(r'[^ \t\r\n]\Z')
-_TRAILING_NON_NEWLINE_RE = re.compile(r'[^\n]\Z')
-_LEADING_SPACE_RE = re.compile(r'^ ')
+# Tag names are lowercased before they are looked up in these sets.
+_REMOVING_TAGS = frozenset(('script', 'style', 'textarea', 'title'))
+_WS_PRESERVING_TAGS = frozenset(('pre',))
+_NEWLINE_TAGS = frozenset(('br',))
+_BLOCK_TAGS = frozenset(
+    prefix + tag
+    for tag in ('address', 'blockquote', 'dd', 'div', 'dl', 'dt', 'h1', 'h2',
+                'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'ol', 'p', 'pre', 'table',
+                'tr', 'ul')
+    for prefix in ('', '/'))
+_TAB_TAGS = frozenset(('td', 'th'))
+# HTML whitespace is collapsed by mapping it all to spaces and then collapsing
+# runs of spaces, which only needs the regex engine when a run exists.
+_HTML_WHITESPACE_TRANSLATE = str.maketrans('\t\r\n', '   ')
+_SPACE_RUN_RE = re.compile(r'  +')
 _PRESERVE_WHITESPACE_STYLES_RE = re.compile(r'(pre|pre-wrap|break-spaces)$',
                                             re.IGNORECASE)
 _COLLAPSE_WHITESPACE_STYLES_RE = re.compile(r'(normal|nowrap)$', re.IGNORECASE)
 
 
+def _iter_tags(html):
+  """Yields the position, name and attributes of each tag in html, in order.
+
+  Args:
+    html: The HTML to scan.
+
+  Yields:
+    (start, end, name, attrs) tuples. name is None for comments and for '<!'
+    declarations, and attrs is None for comments. The last tuple is
+    (len(html), len(html), None, None) so that callers can handle the text
+    after the last tag.
+  """
+  length = len(html)
+  find = html.find
+  match_name = _TAG_NAME_RE.match
+  match_attrs = _TAG_ATTRS_RE.match
+  # Quote positions, entered outside of any quoted value, from which no
+  # closing '>' can be reached.
+  failed_quotes = set()
+  # Caches of the next '-->', newline and attribute delimiter. They stay valid
+  # for later searches since tags are scanned left to right.
+  comment_end = newline = delimiter = -1
+  pos = 0
+  while True:
+    lt = find('<', pos)
+    if lt == -1:
+      break
+    pos = lt + 1
+    name = None
+    if html.startswith('!', pos):
+      if html.startswith('--', pos + 1):
+        if comment_end < lt + 4:
+          comment_end = find('-->', lt + 4)
+          if comment_end == -1:
+            comment_end = length
+        if newline < lt + 4:
+          newline = find('\n', lt + 4)
+          if newline == -1:
+            newline = length
+        if comment_end < newline:
+          pos = comment_end + 3
+          yield lt, pos, None, None
+          continue
+      attrs_start = pos + 1
+    else:
+      name_match = match_name(html, pos)
+      if not name_match:
+        continue
+      name = name_match.group()
+      attrs_start = name_match.end()
+    attrs_match = match_attrs(html, attrs_start)
+    if attrs_match:
+      pos = attrs_match.end()
+    else:
+      # The attributes contain a '<', so walk the quoted values explicitly,
+      # giving up early on quotes already known to be unterminated.
+      if delimiter < attrs_start:
+        delimiter_match = _TAG_ATTRS_DELIMITER_RE.search(html, attrs_start)
+        delimiter = delimiter_match.start() if delimiter_match else length
+      quote = delimiter
+      quotes = []
+      while (quote < length and quote not in failed_quotes and
+             html[quote] != '>'):
+        quotes.append(quote)
+        close_quote = find(html[quote], quote + 1)
+        if close_quote == -1:
+          quote = length
+          break
+        delimiter_match = _TAG_ATTRS_DELIMITER_RE.search(html, close_quote + 1)
+        quote = delimiter_match.start() if delimiter_match else length
+      if quote == length or quote in failed_quotes:
+        failed_quotes.update(quotes)
+        continue
+      pos = quote + 1
+    yield lt, pos, name, html[attrs_start:pos - 1]
+  yield length, length, None, None
+
+
+def _should_preserve_whitespace(stack):
+  """Returns whether whitespace is preserved at the top of stack.
+
+  Args:
+    stack: A list of (tag name, preserves whitespace) tuples for open tags.
+
+  Returns:
+    True if the innermost open tag preserves whitespace.
+  """
+  if stack:
+    return stack[-1][1]
+  return False
+
+
+def _get_style_preserves_whitespace(style):
+  """Gets whether a style attribute value sets whitespace preservation.
+
+  Args:
+    style: The unquoted value of a style attribute.
+
+  Returns:
+    True or False if the style sets white-space, otherwise None.
+  """
+  if 'white-space' not in style.lower():
+    return None
+
+  for match in _STYLE_RE.finditer(style):
+    style_attribute = match.group(1)
+    style_attribute_value = match.group(2)
+    if style_attribute and style_attribute.lower() == 'white-space':
+      if _PRESERVE_WHITESPACE_STYLES_RE.match(style_attribute_value):
+        return True
+      elif _COLLAPSE_WHITESPACE_STYLES_RE.match(style_attribute_value):
+        return False
+
+
+def _get_attributes_preserve_whitespace(attrs):
+  """Gets whether a tag's attributes set whitespace preservation.
+
+  Args:
+    attrs: The attributes of a tag, or None.
+
+  Returns:
+    True or False if a style attribute sets white-space, otherwise None.
+  """
+  # Most tags have no style attribute, so avoid entering the regex engine.
+  if not attrs or 'style' not in attrs.lower():
+    return None
+
+  for match in _ATTR_RE.finditer(attrs):
+    attribute_name = match.group(1)
+    if attribute_name and attribute_name.lower() == 'style':
+      style = match.group(2)
+      if style:
+        # Strip quotes if the attribute value was quoted.
+        if style[0] == '\'' or style[0] == '"':
+          style = style[1:-1]
+        return _get_style_preserves_whitespace(style)
+      return None
+
+
+def _update_preserve_whitespace_stack(stack, tag, attrs):
+  """Pushes or pops stack for an open or close tag.
+
+  Args:
+    stack: A list of (tag name, preserves whitespace) tuples for open tags.
+    tag: The lowercased tag name, starting with '/' for close tags.
+    attrs: The attributes of the tag, or None.
+  """
+  if tag[0] == '/':
+    tag = tag[1:]
+    # Pop tags until we pop one that matches the current closing tag. We're
+    # effectively automatically closing tags that aren't explicitly closed.
+    # If no open tag matches, every tag is popped.
+    index = len(stack) - 1
+    while index >= 0 and stack[index][0] != tag:
+      index -= 1
+    del stack[max(index, 0):]
+  elif tag in _WS_PRESERVING_TAGS:
+    stack.append((tag, True))
+  else:
+    # For unspecified whitespace preservation, inherit from parent tag.
+    preserve_whitespace = _get_attributes_preserve_whitespace(attrs)
+    if preserve_whitespace is None:
+      preserve_whitespace = _should_preserve_whitespace(stack)
+
+    stack.append((tag, preserve_whitespace))
+
+
 def html_to_text(value):
   """Converts HTML to plain text.
 
@@ -160,88 +352,60 @@ def html_to_text(value):
   html = str(value)
   if not isinstance(value, SanitizedHtml):
     return html
-  text = ''
+  # Accumulate output chunks in a list and join once at the end; repeated
+  # string concatenation is quadratic when it can't be done in place.
+  parts = []
+  # The last character appended to parts, or '' if nothing has been output.
+  last_char = ''
   start = 0
   removing_until = ''
   preserve_whitespace_stack = []
 
-  def should_preserve_whitespace():
-    if preserve_whitespace_stack:
-      return preserve_whitespace_stack[-1][1]
-    return False
-
-  def get_style_preserves_whitespace(style):
-    for match in _STYLE_RE.finditer(style):
-      style_attribute = match.group(1)
-      style_attribute_value = match.group(2)
-      if style_attribute and style_attribute.lower() == 'white-space':
-        if _PRESERVE_WHITESPACE_STYLES_RE.match(style_attribute_value):
-          return True
-        elif _COLLAPSE_WHITESPACE_STYLES_RE.match(style_attribute_value):
-          return False
-
-  def get_attributes_preserve_whitespace(attrs):
-    if not attrs:
-      return None
-
-    for match in _ATTR_RE.finditer(attrs):
-      attribute_name = match.group(1)
-      if attribute_name and attribute_name.lower() == 'style':
-        style = match.group(2)
-        if style:
-          # Strip quotes if the attribute value was quoted.
-          if style[0] == '\'' or style[0] == '"':
-            style = style[1:-1]
-          return get_style_preserves_whitespace(style)
-        return None
-
-  def update_preserve_whitespace_stack(tag, attrs):
-    if tag[0] == '/':
-      tag = tag[1:]
-      # Pop tags until we pop one that matches the current closing tag. We're
-      # effectively automatically closing tags that aren't explicitly closed.
-      while preserve_whitespace_stack and (
-          preserve_whitespace_stack.pop()[0] != tag):
-        pass
-    elif _WS_PRESERVING_TAGS_RE.match(tag):
-      preserve_whitespace_stack.append((tag, True))
-    else:
-      # For unspecified whitespace preservation, inherit from parent tag.
-      preserve_whitespace = get_attributes_preserve_whitespace(attrs)
-      if preserve_whitespace is None:
-        preserve_whitespace = should_preserve_whitespace()
-
-      preserve_whitespace_stack.append((tag, preserve_whitespace))
-
-  for match in _TAG_RE.finditer(html):
-    offset = match.start()
-    tag = match.group(1).lower() if match.group(1) else None
-    attrs = match.group(2)
+  # Bind the callables used per tag to locals to avoid repeated global and
+  # attribute lookups in the loop below.
+  unescape = html_module.unescape
+  collapse_spaces = _SPACE_RUN_RE.sub
+  append = parts.append
+  for offset, end, tag, attrs in _iter_tags(html):
+    if tag:
+      tag = tag.lower()
     if not removing_until:
       chunk = html[start:offset]
-      chunk = html_module.unescape(chunk)
-      if not should_preserve_whitespace():
-        chunk = _HTML_WHITESPACE_RE.sub(' ', chunk)
-        if not _TRAILING_NON_WHITESPACE_RE.search(text):
-          chunk = _LEADING_SPACE_RE.sub('', chunk)
-      text += chunk
+      if chunk:
+        # Character references all start with '&', so most chunks need no
+        # unescaping at all.
+        if '&' in chunk:
+          chunk = unescape(chunk)
+        if not _should_preserve_whitespace(preserve_whitespace_stack):
+          chunk = chunk.translate(_HTML_WHITESPACE_TRANSLATE)
+          if '  ' in chunk:
+            chunk = collapse_spaces(' ', chunk)
+          if chunk[:1] == ' ' and (not last_char or last_char in ' \t\r\n'):
+            chunk = chunk[1:]
+        if chunk:
+          append(chunk)
+          last_char = chunk[-1]
       if tag:
-        if _REMOVING_TAGS_RE.match(tag):
+        if tag in _REMOVING_TAGS:
           removing_until = '/' + tag
-        elif _NEWLINE_TAGS_RE.match(tag):
-          text += '\n'
-        elif _BLOCK_TAGS_RE.match(tag):
-          if _TRAILING_NON_NEWLINE_RE.search(text):
-            text += '\n'
-        elif _TAB_TAGS_RE.match(tag):
-          text += '\t'
-
-        if not _HTML5_VOID_ELEMENTS_RE.match('<' + tag + '>'):
-          update_preserve_whitespace_stack(tag, attrs)
+        elif tag in _NEWLINE_TAGS:
+          append('\n')
+          last_char = '\n'
+        elif tag in _BLOCK_TAGS:
+          if last_char and last_char != '\n':
+            append('\n')
+            last_char = '\n'
+        elif tag in _TAB_TAGS:
+          append('\t')
+          last_char = '\t'
+
+        if tag not in _HTML5_VOID_ELEMENTS:
+          _update_preserve_whitespace_stack(
+              preserve_whitespace_stack, tag, attrs)
     elif removing_until == tag:
       removing_until = ''
-    start = match.end()
-  return text.replace('\u00A0', ' ')
+    start = end
+  return ''.join(parts).replace('\u00A0', ' ')
   # LINT.ThenChange(
   #     ../../../../../javascript/template/soy/soyutils_usegoog.js:htmlToText,
   #     ../../java/com/google/template/soy/basicfunctions/HtmlToText.java)
@@ -254,14 +418,11 @@ def escape_css_string(value):
 def escape_html(value):
   html = _get_content_of_kind(value, CONTENT_KIND.HTML)
   if html is not None:
-    approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-        'Persisting existing sanitization.')
-    return SanitizedHtml(html, get_content_dir(value), approval=approval)
+    return SanitizedHtml(html, get_content_dir(value),
+                         approval=_PERSISTING_SANITIZATION_APPROVAL)
 
-  approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-      'Escaped html is by nature sanitized.')
   return SanitizedHtml(generated_sanitize.escape_html_helper(value),
-                       get_content_dir(value), approval=approval)
+                       get_content_dir(value), approval=_ESCAPED_HTML_APPROVAL)
 
 
 def escape_html_attribute(value):
@@ -280,9 +441,15 @@ _NUMBER_RE = re.compile(r'\d*\.?\d+$')
 
 
 def filter_number(value):
-  if not _NUMBER_RE.match(str(value)):
+  # A non-negative int always formats as digits only. Floats and negative
+  # numbers can format with '-', 'e', 'inf' or 'nan', so they go through the
+  # regex like everything else.
+  if type(value) is int and value >= 0:
+    return str(value)
+  value_str = str(value)
+  if not _NUMBER_RE.match(value_str):
     return _INNOCUOUS_OUTPUT
-  return str(value)
+  return value_str
 
 
 def escape_html_attribute_nospace(value):
@@ -370,47 +537,39 @@ def filter_html_element_name(value):
 
 
 def filter_image_data_uri(value):
-  approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-      'Filtered URIs are by nature sanitized.')
   return SanitizedUri(
-      generated_sanitize.filter_image_data_uri_helper(value), approval=approval)
+      generated_sanitize.filter_image_data_uri_helper(value),
+      approval=_FILTERED_URI_APPROVAL)
 
 
 def sms_to_uri(value):
-  approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-      'Filtered URIs are by nature sanitized.')
   return SanitizedUri(
-      generated_sanitize.filter_sms_uri_helper(value), approval=approval)
+      generated_sanitize.filter_sms_uri_helper(value),
+      approval=_FILTERED_URI_APPROVAL)
 
 
 def filter_sip_uri(value):
-  approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-      'Filtered URIs are by nature sanitized.')
   return SanitizedUri(
-      generated_sanitize.filter_sip_uri_helper(value), approval=approval)
+      generated_sanitize.filter_sip_uri_helper(value),
+      approval=_FILTERED_URI_APPROVAL)
 
 
 def filter_tel_uri(value):
-  approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-      'Filtered URIs are by nature sanitized.')
   return SanitizedUri(
-      generated_sanitize.filter_tel_uri_helper(value), approval=approval)
+      generated_sanitize.filter_tel_uri_helper(value),
+      approval=_FILTERED_URI_APPROVAL)
 
 
 def filter_legacy_uri_behavior(value):
-  approval = IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
-      'Filtered URIs are by nature sanitized.'
-  )
   return SanitizedUri(
       generated_sanitize.filter_legacy_uri_behavior_helper(value),
-      approval=approval,
+      approval=_FILTERED_URI_APPROVAL,
   )
 
 
 def filter_normalize_uri(value):
-  uri = _get_content_of_kind(value, CONTENT_KIND.URI)
-  if uri is None:
-    uri = _get_content_of_kind(value, CONTENT_KIND.TRUSTED_RESOURCE_URI)
+  uri = _get_content_of_kinds(
+      value, (CONTENT_KIND.URI, CONTENT_KIND.TRUSTED_RESOURCE_URI))
   if uri is None:
     return generated_sanitize.filter_normalize_uri_helper(value)
 
@@ -418,9 +577,8 @@ def filter_normalize_uri(value):
 
 
 def filter_normalize_media_uri(value):
-  uri = _get_content_of_kind(value, CONTENT_KIND.URI)
-  if uri is None:
-    uri = _get_content_of_kind(value, CONTENT_KIND.TRUSTED_RESOURCE_URI)
+  uri = _get_content_of_kinds(
+      value, (CONTENT_KIND.URI, CONTENT_KIND.TRUSTED_RESOURCE_URI))
   if uri is None:
     return generated_sanitize.filter_normalize_media_uri_helper(value)
 
@@ -448,29 +606,17 @@ def normalize_uri(value):
 
 def filter_html_script_phrasing_data(value):
   """See docs on soy.$$filterHtmlScriptPhrasingData in soyutils_usegoog.js."""
-
-  def ascii_to_lower(c):
-    if 'A' <= c <= 'Z':
-      return c.lower()
-    return c
-
-  def match_prefix_ignore_case_past_end(needle, haystack, offset):
-    chars_left = len(haystack) - offset
-    chars_to_scan = min(len(needle), chars_left)
-    for i in range(chars_to_scan):
-      if needle[i] != ascii_to_lower(haystack[i + offset]):
-        return False
-    return True
-
   value_str = str(value)
+  # Only ASCII letters are folded so that offsets match value_str.
+  lower_str = value_str.translate(_ASCII_LOWER_TRANSLATE)
   start = 0
   while True:
-    lt = value_str.find('<', start)
+    lt = lower_str.find('<', start)
     if lt == -1:
       break
-    if match_prefix_ignore_case_past_end(
-        '<!--', value_str, lt) or match_prefix_ignore_case_past_end(
-            '</script', value_str, lt):
+    # A needle also matches if the value ends partway through it.
+    if ('<!--'.startswith(lower_str[lt:lt + 4]) or
+        '</script'.startswith(lower_str[lt:lt + 8])):
       return 'zSoyz'
     start = lt + 1
   return value_str
@@ -522,7 +668,25 @@ def _get_content_of_kind(value, content_kind):
   Returns:
     String content of value or None if other kind.
   """
-  if is_content_kind(value, content_kind):
+  if (isinstance(value, SanitizedContent) and
+      value.content_kind == content_kind):
+    return value.content
+
+  return None
+
+
+def _get_content_of_kinds(value, content_kinds):
+  """Gets string content from value if it's of any kind in content_kinds.
+
+  Args:
+    value: Value of any type.
+    content_kinds: A tuple of acceptable content kinds.
+
+  Returns:
+    String content of value or None if other kind.
+  """
+  if (isinstance(value, SanitizedContent) and
+      value.content_kind in content_kinds):
     return value.content
 
   return None
@@ -550,7 +714,7 @@ def _strip_html_tags(value, tag_whitelist=None):
 
   Args:
     value: The input string.
-    tag_whitelist: A list of safe tag names.
+    tag_whitelist: A set of safe tag names.
   Returns:
     A string with non-whitelisted tags stripped.
   """
@@ -558,8 +722,8 @@ def _strip_html_tags(value, tag_whitelist=None):
     # The second level (replacing '<' with '&lt;') ensures that non-tag uses of
     # '<' do not recombine into tags as in
     # '<<foo>script>alert(1337)</<foo>script>'
-    return generated_sanitize._LT_REGEX.sub(
-        '&lt;', generated_sanitize._HTML_TAG_REGEX.sub('', value))
+    return generated_sanitize._HTML_TAG_REGEX.sub('', value).translate(
+        _LT_TRANSLATE)
 
   # Escapes '[' so that we can use [123] below to mark places where tags
   # have been removed.
@@ -569,7 +733,22 @@ def _strip_html_tags(value, tag_whitelist=None):
   # [1] which are indices into a list of approved tag names.
   # Replace all other uses of < and > with entities.
   tags = []
-  tag_handler = functools.partial(_tag_sub_handler, tag_whitelist, tags)
+  append_tag = tags.append
+
+  def tag_handler(match):
+    # Replace whitelisted tags with index markers and strip all others.
+    name = match.group(1)
+    if name:
+      name = name.lower()
+      # TODO(user): We need special handling to preserve HTML attribute "dir".
+      # Similar to what we have in JsSrc:
+      if name in tag_whitelist:
+        start = '</' if match.group(0)[1] == '/' else '<'
+        index = len(tags)
+        append_tag(f'{start}{name}>')
+        return f'[{index}]'
+    return ''
+
   html = generated_sanitize._HTML_TAG_REGEX.sub(tag_handler, html)
 
   # Escape HTML special characters. Now there are no '<' in html that could
@@ -584,7 +763,9 @@ def _strip_html_tags(value, tag_whitelist=None):
   # part of a tag via a replacement operation and tags only contains
   # approved tags.
   # Reinsert the white-listed tags.
-  html = _REPLACEMENT_TAG_RE.sub(lambda match: tags[int(match.group(1))], html)
+  get_tag = tags.__getitem__
+  html = _REPLACEMENT_TAG_RE.sub(lambda match: get_tag(int(match.group(1))),
+                                 html)
 
   # Close any still open tags.
   # This prevents unclosed formatting elements like <ol> and <table> from
@@ -602,6 +783,9 @@ def _embed_css_into_html(css):
   Returns:
     Embeddable safe CSS content
   """
+  # Most CSS contains neither hazard, so avoid entering the regex engine.
+  if '</' not in css and ']]>' not in css:
+    return css
   return _HTML_RAW_CONTENT_HAZARD_RE.sub(_defang_raw_content_hazard, css)
 
 
@@ -610,32 +794,20 @@ def _defang_raw_content_hazard(match):
   return _HTML_RAW_CONTENT_HAZARD_REPLACEMENTS[match.group(0)]
 
 
-def _tag_sub_handler(tag_whitelist, tags, match):
-  """Replace whitelisted tags with markers and update the tag list.
+@functools.lru_cache()
+def _merge_safe_tags(safe_tags):
+  """Joins extra safe tags with the default whitelist.
+
+  Generated templates pass the same tags on every call, so the merged set is
+  cached rather than rebuilt for each clean_html call.
 
   Args:
-    tag_whitelist: A list containing all whitelisted html tags.
-    tags: The list of all whitelisted tags found in the text.
-    match: The current match element with a subgroup containing the tag name.
+    safe_tags: A tuple of additional safe tag names.
 
   Returns:
-    The replacement content, a index marker for whitelisted tags, or an empty
-    string.
+    A frozenset of the given tag names and the default whitelist.
   """
-  tag = match.group(0)
-  name = match.group(1)
-  if name:
-    name = name.lower()
-
-  # TODO(user): We need special handling to preserve HTML attribute "dir".
-  # Similar to what we have in JsSrc:
-  if name in tag_whitelist:
-    start = '</' if tag[1] == '/' else '<'
-    index = len(tags)
-    tags.append(start + name + '>')
-    return '[%d]' % index
-
-  return ''
+  return _SAFE_TAG_WHITELIST_SET.union(safe_tags)
 
 
 def _balance_tags(tags):
@@ -690,15 +862,30 @@ class IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval:
       self.justification = justification
 
 
+# Approvals shared by the sanitizers in this module.
+_PERSISTING_SANITIZATION_APPROVAL = (
+    IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
+        'Persisting existing sanitization.'))
+_ESCAPED_HTML_APPROVAL = (
+    IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
+        'Escaped html is by nature sanitized.'))
+_FILTERED_URI_APPROVAL = (
+    IActuallyUnderstandSoyTypeSafetyAndHaveSecurityApproval(
+        'Filtered URIs are by nature sanitized.'))
+
+
+# Names of the CONTENT_KIND values, in order.
+_CONTENT_KIND_NAMES = ('HTML', 'JS', 'JS_STR_CHARS', 'URI',
+                       'TRUSTED_RESOURCE_URI', 'ATTRIBUTES', 'CSS', 'TEXT')
+
+
 class CONTENT_KIND:
   (HTML, JS, JS_STR_CHARS, URI, TRUSTED_RESOURCE_URI, ATTRIBUTES, CSS,
    TEXT) = range(1, 9)
 
   @staticmethod
   def decodeKind(i):
-    i -= 1
-    return ['HTML', 'JS', 'JS_STR_CHARS', 'URI', 'TRUSTED_RESOURCE_URI',
-            'ATTRIBUTES', 'CSS', 'TEXT'][i]
+    return _CONTENT_KIND_NAMES[i - 1]
 
 
 class DIR: